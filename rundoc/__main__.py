@@ -1,22 +1,27 @@
 """
 Main module for rundoc command line utility.
 """
-from rundoc import parsers, ansi
+from rundoc import ansi
 from textwrap import dedent
 import click
-import logging
+import functools
 import rundoc
 import sys
 
-logger = logging.getLogger(__name__)
+# messages with colors substituted once at import time
+_yes_deprecated = ansi.yellow + \
+    "Deprecated option: -y, --yes. See -a, --ask instead." + ansi.end
+_error_template = ansi.red + "{}" + ansi.end
+
+def log_error(msg):
+    "Log error message. Logging is imported only when there is one to log."
+    import logging
+    logging.getLogger(__name__).error(msg)
 
 def add_options(options:list):
     "Aggregate click options from a list and pass as single decorator."
-    def _add_options(func):
-        for option in reversed(options):
-            func = option(func)
-        return func
-    return _add_options
+    return functools.partial(
+        functools.reduce, lambda func, option: option(func), options[::-1])
 
 _run_control_options = [
     click.option('-s', '--step', default=1, show_default=True,
@@ -43,6 +48,9 @@ _run_control_options = [
     click.option('-b', '--breakpoint', type=int, multiple=True,
         help="""Step number on which to force prompt for code input. You can use this option multiple times to add multiple breakpoints.""",
     ),
+    click.option('--parallel', type=click.IntRange(min=0), default=0, show_default=True,
+        help="""Max number of code blocks to run at the same time. Consecutive code blocks tagged with 'parallel' tag will be run simultaneously and their output printed once all of them are done. Ignored with -aa and more. Disabled if 0.""",
+    ),
 ]
 
 _run_specific_options = [
@@ -54,6 +62,12 @@ _run_specific_options = [
     ),
 ]
 
+_parse_options = [
+    click.option('-C', '--cache', is_flag=True,
+        help="""Cache parsed code blocks and tags in user's cache directory ($XDG_CACHE_HOME/rundoc or ~/.cache/rundoc). Next time the same markdown file is used with the same tags, it will be loaded from cache instead of being parsed again.""",
+    ),
+]
+
 _output_style_options = [
     click.option('--light', is_flag=True,
         help="Use theme for light terminal background.",
@@ -80,6 +94,8 @@ _tag_options = [
     help="Enable debug mode with output of each action in the log.")
 @click.pass_context
 def cli(ctx, **kwargs): # pragma: no cover
+    # not called for --version and shell completion, which don't log anything
+    import logging
     logging.basicConfig(
         format = '%(asctime)s.%(msecs)03d, %(levelname)s: %(message)s',
         datefmt = '%Y-%m-%d %H:%M:%S',
@@ -92,14 +108,16 @@ def cli(ctx, **kwargs): # pragma: no cover
 @add_options(_output_style_options)
 @add_options(_tag_options)
 @add_options(_run_specific_options)
+@add_options(_parse_options)
 @click.argument('input', type=click.File('r'))
 def run(**kwargs): # pragma: no cover
     "Run code from markdown file."
-    if kwargs['yes']: print("{}Deprecated option: -y, --yes. See -a, --ask instead.{}".format(ansi.yellow, ansi.end))
+    from rundoc import parsers
+    if kwargs['yes']: print(_yes_deprecated)
     try:
         commander = parsers.parse_doc(**kwargs)
     except rundoc.BadEnv as e:
-        print("{}{}{}".format(ansi.red, e, ansi.end))
+        print(_error_template.format(e))
         sys.exit(1)
     try:
         commander.run(**kwargs)
@@ -107,7 +125,7 @@ def run(**kwargs): # pragma: no cover
         commander.die_with_grace()
         sys.exit(1)
     except rundoc.BadEnv as e:
-        print("{}{}{}".format(ansi.red, e, ansi.end))
+        print(_error_template.format(e))
         sys.exit(1)
     except rundoc.CodeFailed as e:
         sys.exit(1)
@@ -118,11 +136,12 @@ def run(**kwargs): # pragma: no cover
 @click.argument('input', type=click.File('r'))
 def replay(**kwargs): # pragma: no cover
     "Run code from the output of 'run' command."
-    if kwargs['yes']: print("{}Deprecated option: -y, --yes. See -a, --ask instead.{}".format(ansi.yellow, ansi.end))
+    from rundoc import parsers
+    if kwargs['yes']: print(_yes_deprecated)
     try:
         commander = parsers.parse_output(**kwargs)
     except Exception as e:
-        logger.error('Failed to parse file: {}'.format(e))
+        log_error('Failed to parse file: {}'.format(e))
         sys.exit(1)
     try:
         commander.run(**kwargs)
@@ -130,16 +149,18 @@ def replay(**kwargs): # pragma: no cover
         commander.die_with_grace()
         sys.exit(1)
     except rundoc.BadEnv as e:
-        print("{}{}{}".format(ansi.red, e, ansi.end))
+        print(_error_template.format(e))
         sys.exit(1)
     except rundoc.CodeFailed as e:
         sys.exit(1)
 
 
 @cli.command(name='list-tags')
+@add_options(_parse_options)
 @click.argument('input', type=click.File('r'))
 def list_tags(**kwargs): # pragma: no cover
     "List all unique tags in the markdown file."
+    from rundoc import parsers
     try:
         tags = parsers.get_tags(**kwargs)
         max_num_len = len(str(tags[0][0]))
@@ -147,13 +168,13 @@ def list_tags(**kwargs): # pragma: no cover
             print("{}{}{}".format(
                 value, ' '*(max_num_len - len(str(value))), key))
     except Exception as e:
-        logger.error('Failed to parse file: {}'.format(e))
+        log_error('Failed to parse file: {}'.format(e))
         sys.exit(1)
 
 @cli.command(name='action-tags')
 def special_tags(**kwargs): # pragma: no cover
     "Show available action tags and their use in markdown."
-    block_actions = rundoc.block.block_actions
+    from rundoc.block import block_actions
     action_tags_info = ""
     for key in block_actions.keys():
         action_tags_info += "\n" + block_actions[key].__doc__
@@ -163,24 +184,27 @@ def special_tags(**kwargs): # pragma: no cover
 @cli.command(name='list-blocks')
 @add_options(_tag_options)
 @add_options(_output_style_options)
+@add_options(_parse_options)
 @click.option('--pretty', is_flag=True, help="Human readable terminal output.")
 @click.argument('input', type=click.File('r'))
 def list_blocks(**kwargs): # pragma: no cover
     "List all blocks that would be executed with selected tags and parameters."
+    from rundoc import parsers
     try:
         print(parsers.get_blocks(**kwargs))
     except Exception as e:
-        logger.error('Failed to parse file: {}'.format(e))
+        log_error('Failed to parse file: {}'.format(e))
         sys.exit(1)
 
 @cli.command(name='clean-doc')
 @click.argument('input', type=click.File('r'))
 def clean_doc(**kwargs): # pragma: no cover
     "Read markdown file, strip any rundoc specific markup and send to stdout."
+    from rundoc import parsers
     try:
         print(parsers.get_clean_doc(**kwargs))
     except Exception as e:
-        logger.error('Failed to parse file: {}'.format(e))
+        log_error('Failed to parse file: {}'.format(e))
         sys.exit(1)
 
 if __name__ == '__main__': # pragma: no cover
@@ -2,29 +2,113 @@
 Contains class representation of executable code block.
 """
 from collections import OrderedDict
-from prompt_toolkit import prompt
-from prompt_toolkit.lexers import PygmentsLexer
-from prompt_toolkit.styles import style_from_pygments_cls
-from pygments import highlight
-from pygments.formatters import Terminal256Formatter
-from pygments.lexers import get_lexer_by_name
 from rundoc import BadEnv, CodeFailed, BadInterpreter
+import functools
 import grp
 import logging
 import os
 import pwd
 import re
-import select
+import shutil
 import subprocess
 import sys
+import tempfile
 import time
 
+# Code longer than this is passed to the interpreter through a temporary file
+# instead of a pipe. Writing more than pipe capacity to the interpreter's stdin
+# before reading its output could block both processes.
+stdin_pipe_limit = 8192
+
+@functools.lru_cache(maxsize=None)
+def _which(name, path):
+    "Cached shutil.which() for executable `name` in `path`."
+    return shutil.which(name, path=path)
+
+def which(name):
+    """Return absolute path of executable `name` found in PATH or None.
+
+    Lookups are cached per name and PATH, so code blocks sharing the same
+    interpreter search PATH only once.
+    """
+    return _which(name, os.environ.get('PATH'))
+
+@functools.lru_cache(maxsize=None)
+def _lexer_class_for(interpreter):
+    "Return pygments lexer class for `interpreter` or None if there is none."
+    from pygments.lexers import find_lexer_class_by_name
+    try:
+        return find_lexer_class_by_name(interpreter)
+    except Exception:
+        # ClassNotFound, or a broken lexer plugin found while searching for it
+        return None
+
+@functools.lru_cache(maxsize=None)
+def _lexer_for(interpreter):
+    "Return pygments lexer for `interpreter` or None if there is no such lexer."
+    lexer_class = _lexer_class_for(interpreter)
+    return lexer_class() if lexer_class else None
+
+@functools.lru_cache(maxsize=None)
+def _pygments_lexer_for(interpreter): # pragma: no cover
+    "Return lexer for `interpreter` wrapped for prompt toolkit or None."
+    from prompt_toolkit.lexers import PygmentsLexer
+    lexer_class = _lexer_class_for(interpreter)
+    return PygmentsLexer(lexer_class) if lexer_class else None
+
+@functools.lru_cache(maxsize=None)
+def _highlight_style(light=False):
+    "Return pygments style class for light or dark terminal background."
+    if light:
+        from pygments.styles.manni import ManniStyle as HighlightStyle
+    else:
+        from pygments.styles.native import NativeStyle as HighlightStyle
+    return HighlightStyle
+
+@functools.lru_cache(maxsize=None)
+def is_known_command(name):
+    """Check if bash knows command `name`, e.g. as a builtin.
+
+    Spawns bash, so use it only for names not found by `which`.
+    """
+    return subprocess.call(
+            ['bash','-c','command -v {} 2>&1>/dev/null'.format(name)]
+        ) == 0
+
+@functools.lru_cache(maxsize=None)
+def _formatter_for(style):
+    "Return terminal formatter for pygments style class, shared by all blocks."
+    from pygments.formatters import Terminal256Formatter
+    return Terminal256Formatter(style=style)
+
+@functools.lru_cache(maxsize=128)
+def _highlight(code, interpreter, style):
+    """Return code highlighted for terminal.
+
+    Results are cached, so code printed again (e.g. on retry) is not
+    tokenized again.
+    """
+    from pygments import highlight
+    return highlight(code, _lexer_for(interpreter), _formatter_for(style))
+
+def use_highlighting():
+    """Check if code should be highlighted when printed.
+
+    Highlighting is skipped if stdout is not a terminal, unless it's forced by
+    setting RUNDOC_COLOR environment variable. Setting it to 0, false, no or
+    off disables highlighting even on a terminal. Empty value is ignored.
+    """
+    color = os.environ.get('RUNDOC_COLOR', '').strip().lower()
+    if color:
+        return color not in ('0', 'false', 'no', 'off')
+    return sys.stdout.isatty()
+
 block_actions = OrderedDict()
 def block_action(f):
     """Decorator: Add function as action item in block_actions.
 
     Function needs to accept exactly 2 arguments:
-        args      - List of arguments which is a ':' split of a tag without the
+        args      - Tuple of arguments which is a ':' split of a tag without the
                     first element. First element is used as name of action.
         contents  - Data from the code block.
     """
@@ -32,21 +116,17 @@ def block_action(f):
         f.__name__.replace("_", "-").strip('-'), f)
     return f
 
+_env_placeholder_re = re.compile("%:([A-Za-z_][A-Za-z0-9_]*):%")
+
 def fill_env_placeholders(s):
     "Replace %:VARIABLE:% with value of VARIABLE in os.environ."
-    variables = re.findall("(%:[A-Za-z_][A-Za-z0-9_]*:%)", s)
-    variables = list(set(map(lambda x: x[2:-2], variables)))
-    res = s
-    for variable in variables:
-        res = res.replace("%:"+variable+":%", os.environ.get(variable) or "")
-    return res
+    return _env_placeholder_re.sub(
+        lambda match: os.environ.get(match.group(1), ""), s)
 
 def _write_file_action(args, contents, mode='a', fill=False):
     "Helper function used by 'create-file' and 'append-file' actions."
-    filename    = os.path.expanduser(args.get(0))
-    permissions = args.get(1)
-    user        = args.get(2)
-    group       = args.get(3)
+    filename, permissions, user, group = (tuple(args) + (None,) * 4)[:4]
+    filename = os.path.expanduser(filename)
     uid = None
     gid = None
     if user: # pragma: no cover
@@ -64,10 +144,16 @@ def _write_file_action(args, contents, mode='a', fill=False):
         permissions = int(permissions, 8)
     else:
         permissions = 0o644
-    with open(filename, mode) as fh:
-        fh.write((fill_env_placeholders(contents) if fill else contents)+"\n")
-    os.chmod(filename, permissions)
-    os.chown(filename, uid, gid)
+    data = (fill_env_placeholders(contents) if fill else contents) + "\n"
+    flags = os.O_WRONLY | os.O_CREAT
+    flags |= os.O_TRUNC if mode.startswith('w') else os.O_APPEND
+    # set permissions and owner through the open descriptor instead of
+    # resolving the path again
+    with open(os.open(filename, flags, permissions), 'wb') as fh:
+        fh.write(data.encode())
+        fh.flush()
+        os.fchmod(fh.fileno(), permissions)
+        os.fchown(fh.fileno(), uid, gid)
     return 0
 
 @block_action
@@ -139,14 +225,19 @@ def _usage(args, contents): # pragma: no cover
     """
     sys.exit(0)
 
+@functools.lru_cache(maxsize=512)
+def _parse_action_tag(tag):
+    "Return action name and tuple of its arguments from action tag."
+    action_name, _, action_args = tag.partition(':')
+    return action_name, tuple(filter(bool, action_args.split(':')))
+
 def get_block_action(tag):
     "Return an action function based on code block tag."
-    parts_list = list(filter(bool, tag.split(':')))
-    action_name = parts_list.pop(0)
-    if action_name not in block_actions:
-        return None
-    action_args = dict([i, parts_list[i]] for i in range(0, len(parts_list)))
-    return lambda contents: block_actions[action_name](action_args, contents)
+    if tag.partition(':')[0] not in block_actions:
+        return None # e.g. an interpreter, no need to parse its arguments
+    action_name, action_args = _parse_action_tag(tag)
+    action = block_actions[action_name]
+    return lambda contents: action(action_args, contents)
 
 class DocBlock(object):
     """Single multi-line code block executed as a script.
@@ -155,24 +246,33 @@ class DocBlock(object):
         interpreter (str): Interpreter used to run the code.
         code (str): Base code loaded during initialization.
         process (subprocess.Popen): Process object running the interpreter.
+        output_buffer (bytearray): Raw output collected from the running
+            process. Decoded into 'output' of the last run when it finishes.
         runs (list): List of dictinaries, each containing the following:
             'user_code': User modified version of the code (will be used
                 instead of main code unless it's set to None or empty string).
             'output': Full output of executed code block.
             'retcode': exit code of the code block executed
     """
+    __slots__ = (
+        'HighlightStyle',
+        'interpreter',
+        'code',
+        'tags',
+        'process',
+        'output_buffer',
+        'runs',
+        'is_action',
+        )
+
     def __init__(self, code, tags, light=False):
-        if light:
-            from pygments.styles.manni import ManniStyle as HighlightStyle
-            self.HighlightStyle = HighlightStyle
-        else:
-            from pygments.styles.native import NativeStyle as HighlightStyle
-            self.HighlightStyle = HighlightStyle
+        self.HighlightStyle = _highlight_style(light)
         interpreter = tags[0]
         self.interpreter = interpreter
         self.code = code
         self.tags = tags
         self.process = None
+        self.output_buffer = bytearray()
         self.runs = []  # elements inside are like:
                         #   {
                         #       'user_code':'',
@@ -181,11 +281,10 @@ class DocBlock(object):
                         #       'time_start': None,
                         #       'time_stop': None
                         #   }
-        self.is_action = interpreter.split(':')[0] in block_actions
-        interpreter_exists = subprocess.call(
-                ['bash','-c','command -v {} 2>&1>/dev/null'.format(interpreter)]
-            ) == 0
-        if not self.is_action and not interpreter_exists:
+        self.is_action = interpreter.partition(':')[0] in block_actions
+        # interpreter is looked up again when run, env may change PATH
+        if not (self.is_action or which(interpreter) or is_known_command(
+                interpreter)):
             raise BadInterpreter("Bad interpreter: '{}'".format(interpreter))
 
     @property
@@ -196,12 +295,8 @@ class DocBlock(object):
             return None
 
     def get_lexer(self):
-        try:
-            # try because lexer may not exist for current interpreter
-            return get_lexer_by_name(self.interpreter)
-        except:
-            # no lexer
-            return None
+        # lexer may not exist for current interpreter, lookups are cached
+        return _lexer_for(self.interpreter)
 
     def __str__(self):
         code = ''
@@ -209,13 +304,9 @@ class DocBlock(object):
             code = self.last_run['user_code'].strip()
         else:
             code = self.code
-        if self.get_lexer():
-            return highlight(
-                code,
-                self.get_lexer(),
-                Terminal256Formatter(style=self.HighlightStyle)
-                )
-        return code # pragma: no cover
+        if use_highlighting() and self.get_lexer():
+            return _highlight(code, self.interpreter, self.HighlightStyle)
+        return code
 
     def get_dict(self):
         return {
@@ -226,8 +317,10 @@ class DocBlock(object):
         }
 
     def prompt_user(self, prompt_text='» '): # pragma: no cover
-        lexer = self.get_lexer()
-        pygments_lexer = PygmentsLexer(lexer.__class__) if lexer else None
+        # prompt toolkit takes long to import and is needed only with prompts
+        from prompt_toolkit import prompt
+        from prompt_toolkit.styles import style_from_pygments_cls
+        pygments_lexer = _pygments_lexer_for(self.interpreter)
         # ^^ we have to wrap lexer in PygmentsLexer of prompt toolkit
         self.last_run['user_code'] = prompt(
             prompt_text,
@@ -236,31 +329,45 @@ class DocBlock(object):
             style = style_from_pygments_cls(self.HighlightStyle),
             )
 
-    def print_output(self, final=False):
-        """Read both stdout and stderr, populate them in the variable and print.
+    def print_output(self, final=False, echo=True):
+        """Read merged stdout and stderr in chunks, collect and print them.
+
+        Chunks are read straight from the pipe file descriptor, skipping the
+        buffered reader, collected as raw bytes and decoded only once the code
+        block finished running (see `run`).
 
         Args:
-            final (bool): Used to collect final bytes after the process exists.
+            final (bool): Keep reading until end of output instead of returning
+                after the first chunk.
+            echo (bool): Print output as it arrives. Defaults to True.
+        """
+        if not self.process: # might be an action
+            return
+        fd = self.process.stdout.fileno()
+        collect = self.output_buffer.extend
+        if echo:
+            # chunks go straight to the binary buffer, so text printed before
+            # must be written out first
+            sys.stdout.flush()
+            write = sys.stdout.buffer.write
+            flush = sys.stdout.buffer.flush
+        while True:
+            chunk = os.read(fd, 65536)
+            if chunk:
+                collect(chunk)
+                if echo:
+                    write(chunk)
+                    flush() # even without new line, e.g. progress output
+            if not (final and chunk):
+                return
+
+    def run(self, prompt=True, echo=True):
+        """Run the code block and collect its output in a new run.
+
+        Args:
+            prompt (bool): Let user modify the code before running it.
+            echo (bool): Print output of the code block as it arrives.
         """
-        encoding = sys.stdout.encoding
-        if final and self.process: # ask for process because might be an action
-            line = self.process.stdout.read().decode(encoding)
-            self.last_run['output'] += line
-            sys.stdout.write(line)
-        else:
-            str_chunk = None
-            chunk = bytes()
-            while not isinstance(str_chunk, str):
-                assert self.process
-                chunk += self.process.stdout.read(1)
-                try:
-                    str_chunk = chunk.decode(encoding)
-                except:
-                    str_chunk = None
-            self.last_run['output'] += str_chunk
-            sys.stdout.write(str_chunk)
-
-    def run(self, prompt=True):
         if not self.process:
             self.runs.append(
                 {
@@ -284,25 +391,43 @@ class DocBlock(object):
                 self.process = None
                 return
             else:
+                self.output_buffer = bytearray()
+                code = code.encode()
+                if len(code) > stdin_pipe_limit:
+                    stdin = tempfile.TemporaryFile()
+                    stdin.write(code)
+                    stdin.seek(0)
+                else:
+                    stdin = subprocess.PIPE
+                # absolute path of executable lets subprocess use posix_spawn
+                # instead of fork and exec; resolved now because PATH may be
+                # set by env of the document
                 self.process = subprocess.Popen(
                     [self.interpreter],
-                    stdin=subprocess.PIPE,
+                    executable=which(self.interpreter),
+                    stdin=stdin,
                     stdout=subprocess.PIPE,
                     stderr=subprocess.STDOUT,
-                    shell=False,
+                    close_fds=False, # file descriptors are non-inheritable
                     )
-                self.process.stdin.write(code.encode())
-                self.process.stdin.flush()
-                self.process.stdin.close()
-        while self.process and self.process.poll() is None:
-            self.print_output()
-        self.print_output(final=True)
+                if stdin == subprocess.PIPE:
+                    self.process.stdin.write(code)
+                    self.process.stdin.close() # flushes before closing
+                else:
+                    stdin.close() # interpreter has its own file descriptor
+        try:
+            # read until all writers closed the pipe, then reap the process
+            self.print_output(final=True, echo=echo)
+        finally:
+            self.last_run['output'] = self.output_buffer.decode(
+                sys.stdout.encoding or 'utf-8', 'replace')
+        self.last_run['retcode'] = self.process.wait()
         self.last_run['time_stop'] = time.time()
-        self.last_run['retcode'] = self.process.poll()
         self.process = None
 
     def kill(self):
-        if self.process:
-             self.process.kill()
+        process = self.process # may be reset by the thread running it
+        if process:
+            process.kill()
 
 
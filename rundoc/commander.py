@@ -2,7 +2,6 @@
 Classes and tools for manipulating code block execution.
 """
 from collections import OrderedDict
-from prompt_toolkit import prompt
 from rundoc import ansi, RundocException, BadEnv, CodeFailed, BadInterpreter
 from rundoc.block import DocBlock
 from time import sleep
@@ -11,6 +10,22 @@ import logging
 import os
 import sys
 
+logger = logging.getLogger(__name__)
+
+# step banners and messages, with colors substituted once at import time
+_step_template = "\n" + ansi.bold + "=== Step {}/{} [{}] {}" + ansi.end
+_step_done_template = ansi.green + "==== Step {} done" + ansi.end + "\n"
+_step_failed_template = "==== " + ansi.red + \
+    "Failed at step {} with exit code '{}'" + ansi.end + "\n"
+_retry_template = ansi.bold + "Retry number {}/{}." + ansi.end
+_try_again_template = ansi.red + ansi.bold + \
+    "Press RETURN to try again at step {}.\nCtrl+C to quit." + ansi.end
+_interrupted_template = "\n==== " + ansi.red + \
+    "Quit at step {} with keyboard interrupt." + ansi.end + "\n"
+_run_message = "\n" + ansi.bold + \
+    "Running code blocks from supplied documentation." + \
+    "\nModify and/or confirm displayed code by pressing Return." + ansi.end
+
 class OrderedEnv(OrderedDict):
     """Dictionary of environment variables.
 
@@ -30,7 +45,7 @@ class OrderedEnv(OrderedDict):
         self.title = title
 
     def __str__(self):
-        return "\n".join([ var+"="+self[var] for var in self ])
+        return "\n".join([ var+"="+val for var, val in self.items() ])
 
     def append(self, var, val, collect_existing_env=True):
         if collect_existing_env:
@@ -42,11 +57,12 @@ class OrderedEnv(OrderedDict):
             self.append(var, env[var], collect_existing_env)
 
     def import_string(self, env_string, collect_existing_env=True):
-        for line in env_string.strip().split('\n'):
+        for line in env_string.splitlines():
+            line = line.strip()
             if not line: continue
-            if '=' not in line:
+            var, separator, val = line.partition('=')
+            if not separator:
                 raise BadEnv("Bad environment line: {}".format(line))
-            var, val = line.split('=', 1)
             var = var.strip()
             val = val.strip()
             if not var:
@@ -62,6 +78,7 @@ class OrderedEnv(OrderedDict):
         msg = msg.format(ansi.bold, ansi.end)
         print(msg)
         env_string = str(self)
+        from prompt_toolkit import prompt # slow import, needed only here
         env_string = prompt( '[env]\n', default = env_string )
         self.clear()
         self.import_string(env_string, collect_existing_env=False)
@@ -78,8 +95,7 @@ class OrderedEnv(OrderedDict):
         """
         Set environment according to defined variables.
         """
-        for var in self:
-            os.environ[var] = self[var]
+        os.environ.update(self)
 
     def inherit_existing_env(self):
         """
@@ -87,15 +103,26 @@ class OrderedEnv(OrderedDict):
         when you want "outside" environment to have authority over locally
         defined values.
         """
+        environ = os.environ
         for var in self:
-            val = os.environ.get(var, '') or self.get(var)
-            self[var] = val
+            val = environ.get(var)
+            if val and val != self[var]: # keep local value if not exported
+                self[var] = val
 
 
 class DocCommander(object):
     """
     Manages environment and DocBlock objects and executes them in succession.
     """
+    __slots__ = (
+        'env',
+        'secrets',
+        'doc_blocks',
+        'running',
+        'step',
+        'output',
+        )
+
     def __init__(self):
         self.env = OrderedEnv(
             "\n{}==== env variables{}".format(ansi.bold, ansi.end)
@@ -136,31 +163,138 @@ class DocCommander(object):
                     )
                 )
         except RundocException as re:
-            logging.error(str(re))
+            logger.error(str(re))
             sys.exit(1)
 
     def die_with_grace(self):
         if self.running:
-            self.doc_block.kill()
-            print("\n==== {}Quit at step {} with keyboard interrupt.{}\n".format(
-                ansi.red,
-                self.step,
-                ansi.end,
-                )
-            )
+            for doc_block in self.doc_blocks:
+                # more than one may be running in a parallel group
+                doc_block.kill()
+            print(_interrupted_template.format(self.step))
+        self.dump_output()
+
+    def dump_output(self):
+        """Stream json representation of the session into output file.
+
+        Keys are sorted so output files are stable and easy to diff.
+        """
         if self.output:
-            self.output.write(
-                json.dumps(self.get_dict(), sort_keys=True, indent=4))
+            json.dump(self.get_dict(), self.output, sort_keys=True, indent=4)
 
     def write_output(self):
         if self.output:
-            self.output.write(
-                json.dumps(self.get_dict(), sort_keys=True, indent=4))
+            self.dump_output()
             print("Output written to: {}".format(self.output.name))
 
+    def get_parallel_group(self, breakpoint=[]):
+        """Return list of consecutive doc_blocks tagged 'parallel'.
+
+        Group starts at current step and ends at first doc_block that is not
+        tagged as 'parallel' or is a breakpoint.
+        """
+        group = []
+        for step in range(self.step, len(self.doc_blocks)+1):
+            doc_block = self.doc_blocks[step-1]
+            if step in breakpoint or 'parallel' not in doc_block.tags[1:]:
+                break
+            group.append(doc_block)
+        return group
+
+    def run_parallel(self, group, parallel, pause=0, retry=0, retry_pause=1):
+        """Run a group of doc_blocks starting at current step simultaneously.
+
+        Output of each doc_block is collected and printed in order of steps
+        once all of them are finished. Failed doc_blocks are retried together.
+
+        Args:
+            group (list): DocBlock objects starting at current step.
+            parallel (int): Max number of doc_blocks running at the same time.
+            pause (float): A delay in seconds before the start of the group.
+            retry (int): Number of times a step will retry to execute before
+                giving up and failing.
+            retry_pause (float): Additional pause before retrying failed steps.
+        """
+        first_step = self.step
+        pending = group
+        sleep(pause)
+        while pending:
+            self._run_threads(pending, parallel)
+            failed = []
+            for doc_block in pending:
+                step = first_step + group.index(doc_block)
+                print(_step_template.format(
+                    step,
+                    len(self.doc_blocks),
+                    doc_block.interpreter,
+                    ' '.join(doc_block.tags[1:]),
+                    ))
+                print(doc_block)
+                # raw output like when printed by DocBlock.print_output, stdout
+                # may not be able to encode the decoded text
+                sys.stdout.flush()
+                sys.stdout.buffer.write(bytes(doc_block.output_buffer))
+                sys.stdout.buffer.flush()
+                if doc_block.last_run['retcode'] == 0:
+                    print(_step_done_template.format(step))
+                    continue
+                print(_step_failed_template.format(
+                    step, doc_block.last_run['retcode']))
+                failed.append(doc_block)
+            pending = failed
+            if not pending:
+                break
+            self.step = first_step + group.index(pending[0])
+            if len(pending[0].runs) > retry:
+                self.running = False
+                self.write_output()
+                raise CodeFailed("Failed at step {} with exit code '{}'".format(
+                        self.step, pending[0].last_run['retcode']))
+            print(_retry_template.format(len(pending[0].runs), retry), end="")
+            sleep(retry_pause)
+        self.step = first_step + len(group)
+
+    @staticmethod
+    def _run_threads(doc_blocks, parallel):
+        """Run doc_blocks in at most `parallel` threads and wait for them.
+
+        Threads are daemonic and not waited for if interrupted (e.g. with
+        KeyboardInterrupt), because a killed interpreter may leave children
+        that keep its output open. Blocks still waiting for a free thread are
+        not started then.
+        """
+        import threading
+        slots = threading.BoundedSemaphore(parallel)
+        stop = threading.Event()
+        errors = []
+        def run_block(doc_block):
+            with slots:
+                if stop.is_set():
+                    return
+                try:
+                    doc_block.run(False, False)
+                except BaseException as e:
+                    errors.append(e)
+        threads = [ threading.Thread(target=run_block, args=(doc_block,),
+            daemon=True) for doc_block in doc_blocks ]
+        for thread in threads:
+            thread.start()
+        try:
+            for thread in threads:
+                thread.join()
+        except BaseException:
+            stop.set()
+            for thread, doc_block in zip(threads, doc_blocks):
+                doc_block.kill()
+                thread.join(0.1) # block may have been just starting
+                doc_block.kill()
+            raise
+        if errors:
+            raise errors[0]
+
     def run(self,
         step=1, ask=False, breakpoint=[], inherit_env=False, pause=0, retry=0,
-        retry_pause=1, output=None, **kwargs):
+        retry_pause=1, output=None, parallel=0, **kwargs):
         """Run all the doc_blocks one by one starting from `step`.
 
         Args:
@@ -176,6 +310,9 @@ class DocCommander(object):
                 giving up and failing.
             retry_pause (float): Additional pause before retrying same step.
             output (file): Writable file-like object.
+            parallel (int): Run consecutive doc_blocks tagged 'parallel' at
+                the same time, this many at most. Used only if user is not
+                prompted for code (`ask` < 2). Disabled if set to 0.
         """
         assert self.running == False
         if output is not None:
@@ -189,21 +326,28 @@ class DocCommander(object):
         else:
             self.env.prompt_missing()
             self.secrets.prompt_missing()
-        msg = "\n{}Running code blocks from supplied documentation."
-        msg += "\nModify and/or confirm displayed code by pressing Return.{}"
-        print(msg.format(ansi.bold, ansi.end))
+        print(_run_message)
         self.env.load()
         self.secrets.load()
         self.running = True
         self.step = step
         ask_for_prompt_once = False
-        while self.step in range(step, len(self.doc_blocks)+1):
+        last_step = len(self.doc_blocks) # blocks can't be added while running
+        while step <= self.step <= last_step:
+            if parallel and ask<2:
+                group = self.get_parallel_group(breakpoint)
+                if len(group) > 1:
+                    self.run_parallel(group, parallel, pause, retry,
+                        retry_pause)
+                    continue
             prompt_this_time = \
                 ask>=3 or ask_for_prompt_once or self.step in breakpoint
-            tags = '[{}] '.format(self.doc_block.interpreter)
-            tags += ' '.join(self.doc_block.tags[1:])
-            prompt_text = "\n{}=== Step {}/{} {}{}".format(
-                ansi.bold, self.step, len(self.doc_blocks), tags, ansi.end)
+            prompt_text = _step_template.format(
+                self.step,
+                last_step,
+                self.doc_block.interpreter,
+                ' '.join(self.doc_block.tags[1:]),
+                )
             print(prompt_text)
             if not prompt_this_time:
                 print(self.doc_block)
@@ -211,18 +355,15 @@ class DocCommander(object):
             self.doc_block.run(prompt = prompt_this_time)
             ask_for_prompt_once = False
             if self.doc_block.last_run['retcode'] == 0:
-                print("{}==== Step {} done{}\n".format(
-                    ansi.green, self.step, ansi.end))
+                print(_step_done_template.format(self.step))
                 self.step += 1
                 continue
             # in case it failed:
             self.running = False
-            print("==== {}Failed at step {} with exit code '{}'{}\n".format(
-                ansi.red, self.step, self.doc_block.last_run['retcode'], ansi.end))
+            print(_step_failed_template.format(
+                self.step, self.doc_block.last_run['retcode']))
             if ask>=2: # pragma: no cover
-                msg = "{}{}Press RETURN to try again at step {}.\n"
-                msg += "Ctrl+C to quit.{}"
-                print(msg.format(ansi.red, ansi.bold, self.step, ansi.end))
+                print(_try_again_template.format(self.step))
                 input()
                 ask_for_prompt_once = True
                 continue
@@ -230,8 +371,8 @@ class DocCommander(object):
                 self.write_output()
                 raise CodeFailed("Failed at step {} with exit code '{}'".format(
                         self.step, self.doc_block.last_run['retcode']))
-            print("{}Retry number {}/{}.".format(
-                ansi.bold, len(self.doc_block.runs), retry, ansi.end), end="")
+            print(_retry_template.format(len(self.doc_block.runs), retry),
+                end="")
             sleep(retry_pause)
         self.step = 0
         self.write_output()
@@ -1,20 +1,43 @@
 """
 Tools for parsing markdown docs.
 """
-from bs4 import BeautifulSoup
 from collections import defaultdict
-from markdown_rundoc.rundoc_code import RundocCodeExtension
 from rundoc.block import DocBlock, block_actions
 from rundoc.commander import DocCommander
+import functools
+import hashlib
 import json
-import markdown
+import logging
 import operator
+import os
 import re
+import rundoc
 
+logger = logging.getLogger(__name__)
 
+# classes of code blocks that define variables instead of code to run
+env_classes = frozenset(('env', 'environ', 'environment'))
+secrets_classes = frozenset(('secret', 'secrets'))
+variable_classes = env_classes | secrets_classes
+
+try:
+    # orjson is much faster at loading large outputs; optional
+    from orjson import loads as json_loads
+except ImportError: # pragma: no cover
+    json_loads = json.loads
+
+
+@functools.lru_cache(maxsize=8)
 def mkd_to_html(mkd, tags='', must_have_tags='', must_not_have_tags='',
         single_session='', selection_tag='rundoc_selected'):
-    """Read markdown stream and return html string."""
+    """Read markdown stream and return html string.
+
+    Results are cached, so parsing the same markdown with the same tags again
+    in the same process does not run markdown conversion again.
+    """
+    # imported here because only commands that parse markdown need it
+    import markdown
+    from markdown_rundoc.rundoc_code import RundocCodeExtension
     html_data = markdown.markdown(
         mkd,
         extensions = [ 
@@ -29,8 +52,118 @@ def mkd_to_html(mkd, tags='', must_have_tags='', must_not_have_tags='',
         )
     return html_data
 
+def html_to_soup(html_data):
+    """Return BeautifulSoup object of html string.
+
+    Uses the C-based lxml parser if it's installed and falls back to Python's
+    html.parser otherwise.
+    """
+    from bs4 import BeautifulSoup, FeatureNotFound
+    try:
+        return BeautifulSoup(html_data, 'lxml')
+    except FeatureNotFound: # pragma: no cover
+        return BeautifulSoup(html_data, 'html.parser')
+
+def _cache_file(*key):
+    """Return path of the cache file for `key` in the user's cache directory.
+
+    The directory is created if missing. Cache is stored under
+    $XDG_CACHE_HOME/rundoc (defaults to ~/.cache/rundoc). Versions of rundoc
+    and markdown-rundoc are part of the key because both affect parsing.
+    Returns None if the directory can't be created, parsing then goes on
+    without cache.
+    """
+    import markdown_rundoc
+    cache_dir = os.path.join(
+        os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+        'rundoc',
+        )
+    try:
+        os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+    except OSError as e:
+        logger.debug("Failed to create cache directory {}: {}".format(
+            cache_dir, e))
+        return None
+    key = json.dumps([rundoc.__version__, markdown_rundoc.__version__, key])
+    digest = hashlib.sha256(key.encode()).hexdigest()
+    return os.path.join(cache_dir, digest + '.json')
+
+def _load_cache(path):
+    """Return data stored in the cache file or None if there is no such file."""
+    try:
+        with open(path, 'r') as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return None
+
+def _write_cache(path, data):
+    """Store data in the cache file. Failing to do so is not an error."""
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    try:
+        fd = os.open(tmp_path, os.O_WRONLY|os.O_CREAT|os.O_TRUNC, 0o600)
+        with open(fd, 'w') as fh:
+            json.dump(data, fh)
+        os.replace(tmp_path, path)
+    except (OSError, TypeError, ValueError) as e:
+        logger.debug("Failed to write cache file {}: {}".format(path, e))
+    finally:
+        # temporary file is left only if writing failed, it may hold secrets
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+
+def _extract_doc(mkd, tags="", must_have_tags="", must_not_have_tags="",
+    single_session=""):
+    """Extract selected code blocks, environment and secrets from markdown.
+
+    Returns:
+        Dictionary with 'code_blocks' (list of [code, tags] pairs), 'env' and
+        'secrets' (strings of new line separated var=value pairs).
+    """
+    html_data = mkd_to_html(
+        mkd,
+        tags,
+        must_have_tags,
+        must_not_have_tags,
+        single_session,
+        )
+    soup = html_to_soup(html_data)
+    code_blocks = []
+    all_code = []
+    env_strings = []
+    secrets_strings = []
+    # single pass over selected code blocks, sorting out env and secrets
+    for element in soup.find_all('code', class_='rundoc_selected'):
+        classes = element.get('class') or ()
+        if not variable_classes.isdisjoint(classes):
+            # a block may define both env and secrets, but never runs
+            if not env_classes.isdisjoint(classes):
+                env_strings.append(element.string or '')
+            if not secrets_classes.isdisjoint(classes):
+                secrets_strings.append(element.string or '')
+            continue
+        tags_list = list(filter(bool, classes))
+        tags_list.remove('rundoc_selected')
+        # code elements usually hold a single string, no need to walk it
+        code = element.string
+        code = element.get_text() if code is None else str(code)
+        if single_session:
+            all_code.append(code)
+        else:
+            code_blocks.append([code, tags_list])
+    if single_session:
+        code_blocks.append(["".join(all_code), [single_session]])
+    env_string = "\n".join(env_strings)
+    secrets_string = "\n".join(secrets_strings)
+    return {
+        'code_blocks': code_blocks,
+        'env': env_string,
+        'secrets': secrets_string,
+    }
+
 def parse_doc(input, tags="", must_have_tags="", must_not_have_tags="",
-    single_session="", light=False, **kwargs):
+    single_session="", light=False, cache=False, **kwargs):
     """Parse code blocks from markdown file and return DocCommander object.
 
     Args:
@@ -43,70 +176,28 @@ def parse_doc(input, tags="", must_have_tags="", must_not_have_tags="",
             to contain non of them.
         light (bool): Will use light backgrond color theme if set to True.
             Defaults to False.
+        cache (bool): Store parsed code blocks in user's cache directory and
+            reuse them next time the same markdown is parsed with the same
+            tags. Defaults to False.
 
     Returns:
         DocCommander object.
     """
-
-    html_data = mkd_to_html(
-        input.read(),
-        tags,
-        must_have_tags,
-        must_not_have_tags,
-        single_session,
-        )
-    soup = BeautifulSoup(html_data, 'html.parser')
+    mkd = input.read()
+    args = (mkd, tags, must_have_tags, must_not_have_tags, single_session)
+    doc = None
+    cache_path = _cache_file(*args) if cache else None
+    if cache_path:
+        doc = _load_cache(cache_path)
+    if doc is None:
+        doc = _extract_doc(*args)
+        if cache_path:
+            _write_cache(cache_path, doc)
     commander = DocCommander()
-
-    # find blocks
-    def is_runnable_block(tag):
-        if tag.name != 'code':
-            return False
-        if 'rundoc_selected' not in tag.get('class', {}):
-            return False
-        return not bool({
-            "env",
-            "environ",
-            "environment",
-            "secret",
-            "secrets",
-            }.intersection(tag.get('class', {})))
-    code_block_elements = soup.findAll(is_runnable_block)
-    all_code = ""
-    for element in code_block_elements:
-        tags_list = element.get_attribute_list('class')
-        tags_list = list(filter(bool, tags_list))
-        if tags_list:
-            tags_list.remove('rundoc_selected')
-            if single_session:
-                all_code += element.getText()
-            else:
-                commander.add(element.getText(), tags_list, light)
-    if single_session:
-        commander.add(all_code, [single_session], light)
-
-    # find environments
-    def is_environment(tag):
-        if tag.name != 'code':
-            return False
-        if 'rundoc_selected' not in tag.get('class', {}):
-            return False
-        return bool({'env','environ','environment'}.intersection(
-            tag.get('class', {})))
-    env_elements = soup.findAll(is_environment)
-    env_string = "\n".join([ x.string or '' for x in env_elements ])
-    commander.env.import_string(env_string)
-
-    # find secrets
-    def is_secret(tag):
-        if tag.name != 'code':
-            return False
-        if 'rundoc_selected' not in tag.get('class', {}):
-            return False
-        return bool({'secret','secrets'}.intersection(tag.get('class', {})))
-    secrets_elements = soup.findAll(is_secret)
-    secrets_string = "\n".join([ x.string for x in secrets_elements ])
-    commander.secrets.import_string(secrets_string)
+    for code, tags_list in doc['code_blocks']:
+        commander.add(code, tags_list, light)
+    commander.env.import_string(doc['env'])
+    commander.secrets.import_string(doc['secrets'])
     return commander
 
 def parse_output(input, exact_timing=False, light=False, **kwargs):
@@ -130,7 +221,7 @@ def parse_output(input, exact_timing=False, light=False, **kwargs):
         DocCommander object.
     """
     output_data = input.read()
-    data = json.loads(output_data)
+    data = json_loads(output_data)
     commander = DocCommander()
     for d in data['code_blocks']:
         doc_block = DocBlock(
@@ -139,29 +230,52 @@ def parse_output(input, exact_timing=False, light=False, **kwargs):
             light=light,
             )
         commander.doc_blocks.append(doc_block)
-        commander.env.extend(data['env'])
+    commander.env.extend(data['env'])
     return commander
 
-def get_tags(input, **kwargs):
-    """Read markdown file and return list of available tags."""
+def _count_tags(mkd):
+    """Return dictionary of tags found in markdown and number of their uses."""
     tag_dict = defaultdict(int)
-    html_data = mkd_to_html(input.read())
-    soup = BeautifulSoup(html_data, 'html.parser')
-    match = re.compile("^.+$")
-    code_block_elements = soup.findAll(name='code', attrs={"class":match,})
+    html_data = mkd_to_html(mkd)
+    soup = html_to_soup(html_data)
+    # True matches any class without running a regex against each value;
+    # elements with empty class contribute no tags anyway
+    code_block_elements = soup.find_all('code', class_=True)
     for element in code_block_elements:
-        for class_name in element.get_attribute_list('class'):
+        for class_name in element.get('class'):
             tag_dict[class_name] += 1
     if 'rundoc_selected' in tag_dict:
         del(tag_dict['rundoc_selected'])
+    return tag_dict
+
+def get_tags(input, cache=False, **kwargs):
+    """Read markdown file and return list of available tags.
+
+    Args:
+        input (file): Readable file-like object pointing to markdown file.
+        cache (bool): Store found tags in user's cache directory and reuse
+            them next time the same markdown is read. Defaults to False.
+
+    Returns:
+        List of (tag, count) tuples sorted by count, most used first.
+    """
+    mkd = input.read()
+    tag_dict = None
+    cache_path = _cache_file('tags', mkd) if cache else None
+    if cache_path:
+        tag_dict = _load_cache(cache_path)
+    if tag_dict is None:
+        tag_dict = _count_tags(mkd)
+        if cache_path:
+            _write_cache(cache_path, tag_dict)
     sorted_tag_dict = sorted(tag_dict.items(), key=operator.itemgetter(1),
         reverse=True)
     return sorted_tag_dict
 
 def get_blocks(input, tags="", must_have_tags="", must_not_have_tags="",
-    single_session="", light=False, pretty=False, **kwargs):
+    single_session="", light=False, pretty=False, cache=False, **kwargs):
     commander = parse_doc(input, tags, must_have_tags, must_not_have_tags,
-        single_session, light)
+        single_session, light, cache)
     blocks = ""
     if pretty:
         step = 0
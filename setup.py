@@ -53,6 +53,12 @@ setup(
         'prompt_toolkit>=2.0,<3.0',
         'pygments>=2.2.0,<3.0',
     ],
+    extras_require = {
+        'fast': [
+            'lxml',
+            'orjson; python_version >= "3.6"',
+        ],
+    },
     python_requires=">=3.4.6",
 )
 
@@ -17,6 +17,8 @@ import io
 import json
 import os
 import re
+import shutil
+import signal
 import stat
 import tempfile
 import threading
@@ -146,7 +148,7 @@ def test_fill_env_placeholders__unopened(environment):
 def test_write_file_action__no_fill(sandbox):
     testfile = os.path.join(sandbox, inspect.currentframe().f_code.co_name)
     before = 'some random text\nmore text'
-    rb._write_file_action({0:testfile, 1:'774'}, before, fill=False)
+    rb._write_file_action((testfile, '774'), before, fill=False)
     with open(testfile, 'r') as f:
         assert f.read() == before + '\n'
 
@@ -156,7 +158,7 @@ def test_write_file_action__fill(sandbox, environment):
     for key in environment:
         before += ' abc %:' + key + ':%'
     after = before.replace('%:', '{').replace(':%', '}').format(**environment)
-    rb._write_file_action({0:testfile, 1:'774'}, before, fill=True)
+    rb._write_file_action((testfile, '774'), before, fill=True)
     with open(testfile, 'r') as f:
         assert f.read() == after + '\n'
 
@@ -166,7 +168,7 @@ def test_create_file__fresh(sandbox, environment):
     for key in environment:
         before += ' abc %:' + key + ':%'
     after = before.replace('%:', '{').replace(':%', '}').format(**environment)
-    rb._create_file({0:testfile}, before)
+    rb._create_file((testfile,), before)
     with open(testfile, 'r') as f:
         assert f.read() == before + '\n'
 
@@ -176,7 +178,7 @@ def test_create_file__existing(sandbox, environment, dummy_file):
     for key in environment:
         before += ' abc %:' + key + ':%'
     after = before.replace('%:', '{').replace(':%', '}').format(**environment)
-    rb._create_file({0:testfile}, before)
+    rb._create_file((testfile,), before)
     with open(testfile, 'r') as f:
         assert f.read() == before + '\n'
 
@@ -186,7 +188,7 @@ def test_r_create_file__fresh(sandbox, environment):
     for key in environment:
         before += ' abc %:' + key + ':%'
     after = before.replace('%:', '{').replace(':%', '}').format(**environment)
-    rb._r_create_file({0:testfile}, before)
+    rb._r_create_file((testfile,), before)
     with open(testfile, 'r') as f:
         assert f.read() == after + '\n'
 
@@ -196,7 +198,7 @@ def test_r_create_file__existing(sandbox, environment, dummy_file):
     for key in environment:
         before += ' abc %:' + key + ':%'
     after = before.replace('%:', '{').replace(':%', '}').format(**environment)
-    rb._r_create_file({0:testfile}, before)
+    rb._r_create_file((testfile,), before)
     with open(testfile, 'r') as f:
         assert f.read() == after + '\n'
 
@@ -207,7 +209,7 @@ def test_create_file__permissions(sandbox, environment):
     for key in environment:
         before += ' abc %:' + key + ':%'
     after = before.replace('%:', '{').replace(':%', '}').format(**environment)
-    rb._create_file({0:testfile, 1:permissions}, before)
+    rb._create_file((testfile, permissions), before)
     with open(testfile, 'r') as f:
         assert f.read() == before + '\n'
     assert str(oct(os.stat(testfile)[stat.ST_MODE]))[-3:] == permissions
@@ -219,7 +221,7 @@ def test_r_create_file__permissions(sandbox, environment):
     for key in environment:
         before += ' abc %:' + key + ':%'
     after = before.replace('%:', '{').replace(':%', '}').format(**environment)
-    rb._r_create_file({0:testfile, 1:permissions}, before)
+    rb._r_create_file((testfile, permissions), before)
     with open(testfile, 'r') as f:
         assert f.read() == after + '\n'
     assert str(oct(os.stat(testfile)[stat.ST_MODE]))[-3:] == permissions
@@ -230,7 +232,7 @@ def test_append_file__fresh(sandbox, environment):
     for key in environment:
         before += ' abc %:' + key + ':%'
     after = before.replace('%:', '{').replace(':%', '}').format(**environment)
-    rb._append_file({0:testfile}, before)
+    rb._append_file((testfile,), before)
     with open(testfile, 'r') as f:
         assert f.read() == before + '\n'
 
@@ -242,7 +244,7 @@ def test_append_file__existing(sandbox, environment, dummy_file):
     for key in environment:
         before += ' abc %:' + key + ':%'
     after = before.replace('%:', '{').replace(':%', '}').format(**environment)
-    rb._append_file({0:testfile}, before)
+    rb._append_file((testfile,), before)
     with open(testfile, 'r') as f:
         assert f.read() == initial_contents + before + '\n'
 
@@ -252,7 +254,7 @@ def test_r_append_file__fresh(sandbox, environment):
     for key in environment:
         before += ' abc %:' + key + ':%'
     after = before.replace('%:', '{').replace(':%', '}').format(**environment)
-    rb._r_append_file({0:testfile}, before)
+    rb._r_append_file((testfile,), before)
     with open(testfile, 'r') as f:
         assert f.read() == after + '\n'
 
@@ -264,7 +266,7 @@ def test_r_append_file__existing(sandbox, environment, dummy_file):
     for key in environment:
         before += ' abc %:' + key + ':%'
     after = before.replace('%:', '{').replace(':%', '}').format(**environment)
-    rb._r_append_file({0:testfile}, before)
+    rb._r_append_file((testfile,), before)
     with open(testfile, 'r') as f:
         assert f.read() ==  initial_contents + after + '\n'
 
@@ -275,7 +277,7 @@ def test_append_file__permissions(sandbox, environment):
     for key in environment:
         before += ' abc %:' + key + ':%'
     after = before.replace('%:', '{').replace(':%', '}').format(**environment)
-    rb._append_file({0:testfile, 1:permissions}, before)
+    rb._append_file((testfile, permissions), before)
     with open(testfile, 'r') as f:
         assert f.read() == before + '\n'
     assert str(oct(os.stat(testfile)[stat.ST_MODE]))[-3:] == permissions
@@ -287,7 +289,7 @@ def test_r_append_file__permissions(sandbox, environment):
     for key in environment:
         before += ' abc %:' + key + ':%'
     after = before.replace('%:', '{').replace(':%', '}').format(**environment)
-    rb._r_append_file({0:testfile, 1:permissions}, before)
+    rb._r_append_file((testfile, permissions), before)
     with open(testfile, 'r') as f:
         assert f.read() == after + '\n'
     assert str(oct(os.stat(testfile)[stat.ST_MODE]))[-3:] == permissions
@@ -296,6 +298,34 @@ def test_docblock_init_with_bad_interpreter():
     with pytest.raises(BadInterpreter):
         rb.DocBlock(tags=['bad_interpreter'], code='')
 
+def test_which():
+    assert rb.which('bash') == shutil.which('bash')
+    assert rb.which('bash') is rb.which('bash')
+    assert rb.which('bad_interpreter') == None
+
+def test_is_known_command():
+    assert rb.is_known_command('cd')
+    assert not rb.is_known_command('bad_interpreter')
+
+def test_docblock__init__no_shell_spawn(monkeypatch):
+    def fail(*args, **kwargs):
+        raise AssertionError("spawned a shell for interpreter in PATH")
+    monkeypatch.setattr(rb.subprocess, 'call', fail)
+    rb.DocBlock('echo', ['bash'])
+
+def test_docblock__run__path_from_env(sandbox, monkeypatch):
+    # restored when the test is done, env.load() below overrides it
+    monkeypatch.setenv('PATH', os.environ['PATH'])
+    fake_bash = os.path.join(sandbox, 'bash')
+    with open(fake_bash, 'w') as f:
+        f.write('#!/bin/sh\necho FAKE-INTERPRETER\n')
+    os.chmod(fake_bash, 0o755)
+    dc = rc.DocCommander()
+    dc.add('echo "real"\n', ['bash'])
+    dc.env.append('PATH', sandbox + os.pathsep + os.environ['PATH'])
+    dc.run()
+    assert dc.doc_blocks[0].last_run['output'] == 'FAKE-INTERPRETER\n'
+
 def test_get_block_action__known_actions():
     for action in {
         'create-file',
@@ -305,6 +335,17 @@ def test_get_block_action__known_actions():
     }:
         assert isinstance(rb.get_block_action(action + ':text'), LambdaType)
 
+def test_get_block_action__cached_args(sandbox):
+    testfile = os.path.join(sandbox, inspect.currentframe().f_code.co_name)
+    tag = 'create-file:' + testfile + ':600'
+    rb._parse_action_tag.cache_clear()
+    for contents in ('first', 'second'):
+        assert rb.get_block_action(tag)(contents) == 0
+    assert rb._parse_action_tag.cache_info().hits == 1
+    with open(testfile, 'r') as fh:
+        assert fh.read() == 'second\n'
+    assert oct(os.stat(testfile).st_mode & 0o777) == oct(0o600)
+
 def test_get_block_action__undefined_action():
     assert rb.get_block_action('unknown:text') == None
 
@@ -317,14 +358,23 @@ def test_docblock__get_lexer__unknown(docblock_unknown):
     db_lexer = docblock_unknown.get_lexer()
     assert db_lexer == None
 
-def test_docblock__str(docblock_bash):
+def test_docblock__get_lexer__cached(docblock_bash):
+    other_block = rb.DocBlock('echo', ['bash'])
+    assert docblock_bash.get_lexer() is other_block.get_lexer()
+    assert docblock_bash.HighlightStyle is NativeStyle
+    assert rb.DocBlock('echo', ['bash'], light=True).HighlightStyle \
+        is ManniStyle
+
+def test_docblock__str(docblock_bash, monkeypatch):
+    monkeypatch.setenv('RUNDOC_COLOR', '1')
     code = docblock_bash.code
     interpreter = docblock_bash.interpreter
     lexer_class = get_lexer_by_name(interpreter)
     s = highlight(code, lexer_class, Terminal256Formatter(style=NativeStyle))
     assert str(docblock_bash) == s
 
-def test_docblock_str__last_run(docblock_bash):
+def test_docblock_str__last_run(docblock_bash, monkeypatch):
+    monkeypatch.setenv('RUNDOC_COLOR', '1')
     user_code = 'echo "changed"'
     docblock_bash.runs.append(
         {
@@ -341,13 +391,39 @@ def test_docblock_str__last_run(docblock_bash):
     s = highlight(user_code, lexer_class, Terminal256Formatter(style=NativeStyle))
     assert str(docblock_bash) == s
 
-def test_docblock__str__light(docblock_bash_light):
+def test_docblock__str__light(docblock_bash_light, monkeypatch):
+    monkeypatch.setenv('RUNDOC_COLOR', '1')
     code = docblock_bash_light.code
     interpreter = docblock_bash_light.interpreter
     lexer_class = get_lexer_by_name(interpreter)
     s = highlight(code, lexer_class, Terminal256Formatter(style=ManniStyle))
     assert str(docblock_bash_light) == s
 
+def test_docblock__str__cached(docblock_bash, monkeypatch):
+    monkeypatch.setenv('RUNDOC_COLOR', '1')
+    rb._highlight.cache_clear()
+    assert str(docblock_bash) is str(docblock_bash)
+    assert rb._highlight.cache_info().hits == 1
+
+def test_docblock__str__not_a_tty(docblock_bash, monkeypatch):
+    monkeypatch.delenv('RUNDOC_COLOR', raising=False)
+    monkeypatch.setattr(rb.sys.stdout, 'isatty', lambda: False)
+    assert str(docblock_bash) == docblock_bash.code
+
+@pytest.mark.parametrize('color, isatty, expect', [
+    ('1', False, True),
+    ('yes', False, True),
+    ('0', True, False),
+    ('false', True, False),
+    ('OFF', True, False),
+    ('', True, True),
+    ('', False, False),
+])
+def test_use_highlighting(color, isatty, expect, monkeypatch):
+    monkeypatch.setenv('RUNDOC_COLOR', color)
+    monkeypatch.setattr(rb.sys.stdout, 'isatty', lambda: isatty)
+    assert rb.use_highlighting() == expect
+
 def test_docblock__get_dict(docblock_bash):
     assert type(docblock_bash.get_dict()) == type({})
     bash_block_dict = {
@@ -374,6 +450,26 @@ def test_docblock__get_dict(docblock_bash):
     assert actual_dict['runs'][0]['time_start'] > 0
     assert actual_dict['runs'][0]['time_stop'] > 0
 
+def test_docblock__run__large_code():
+    # more code and output than fits in a pipe
+    line = 'echo "{}"\n'.format('x'*100)
+    docblock = rb.DocBlock(line * 3000, ['bash', 'test'])
+    assert len(docblock.code) > rb.stdin_pipe_limit
+    docblock.run(prompt=False)
+    assert docblock.last_run['retcode'] == 0
+    assert docblock.last_run['output'] == ('x'*100 + '\n') * 3000
+
+def test_docblock__run__output_after_exit():
+    # background job keeps writing after the interpreter exited
+    docblock = rb.DocBlock(
+        '(sleep 0.5; echo "late") &\necho "early"',
+        ['bash', 'test'],
+    )
+    docblock.run(prompt=False)
+    assert docblock.last_run['retcode'] == 0
+    assert docblock.last_run['output'] == 'early\nlate\n'
+    assert docblock.process == None
+
 def docblock_worker(docblock):
     docblock.run(prompt=False)
 
@@ -443,6 +539,11 @@ def test_orderedenv__import_string(orderedenv, test_vars):
     orderedenv.import_string(s_import)
     assert str(orderedenv) == s + s_import
 
+def test_orderedenv__import_string__blank_lines(orderedenv):
+    orderedenv.clear()
+    orderedenv.import_string("\n  a = b \r\n   \n\tc=d\n\n")
+    assert str(orderedenv) == "a=b\nc=d"
+
 def test_orderedenv__import_string__no_equal(orderedenv, test_vars):
     s_import = "bad env format"
     with pytest.raises(BadEnv):
@@ -576,6 +677,76 @@ def test_doccommander_run__failed():
     with pytest.raises(CodeFailed):
         dc.run(retry=5, retry_pause=0.1)
 
+def test_doccommander_get_parallel_group():
+    dc = rc.DocCommander()
+    dc.add('echo "test1"\n', ['bash','parallel'])
+    dc.add('echo "test2"\n', ['bash','test','parallel'])
+    dc.add('echo "test3"\n', ['bash','test'])
+    dc.add('echo "test4"\n', ['bash','parallel'])
+    dc.step = 1
+    assert dc.get_parallel_group() == dc.doc_blocks[:2]
+    assert dc.get_parallel_group(breakpoint=[2]) == dc.doc_blocks[:1]
+    dc.step = 3
+    assert dc.get_parallel_group() == []
+    dc.step = 4
+    assert dc.get_parallel_group() == dc.doc_blocks[3:]
+
+def test_doccommander_run__parallel():
+    dc = rc.DocCommander()
+    dc.add('sleep 1; echo "test1"\n', ['bash','parallel'])
+    dc.add('sleep 1; echo "test2"\n', ['bash','parallel'])
+    dc.add('sleep 1; echo "test3"\n', ['bash','parallel'])
+    dc.add('echo "test4"\n', ['bash','test'])
+    dc.run(parallel=3)
+    for i, doc_block in enumerate(dc.doc_blocks):
+        assert len(doc_block.runs) == 1
+        assert doc_block.last_run['retcode'] == 0
+        assert doc_block.last_run['output'] == 'test{}\n'.format(i+1)
+    # every block in the group started before any of them finished
+    group = dc.doc_blocks[:3]
+    assert max(b.last_run['time_start'] for b in group) < \
+        min(b.last_run['time_stop'] for b in group)
+
+def test_doccommander_run__parallel_non_ascii(monkeypatch):
+    stdout = io.TextIOWrapper(io.BytesIO(), encoding='ascii')
+    monkeypatch.setattr(rc.sys, 'stdout', stdout)
+    dc = rc.DocCommander()
+    dc.add('printf "\\303\\251\\n"\n', ['bash','parallel'])
+    dc.add('echo "test2"\n', ['bash','parallel'])
+    dc.run(parallel=2)
+    stdout.flush()
+    assert '\u00e9\n'.encode() in stdout.buffer.getvalue()
+
+def test_doccommander_run__parallel_failed():
+    dc = rc.DocCommander()
+    dc.add('echo "test1"\n', ['bash','parallel'])
+    dc.add('cat /non_existent', ['bash','parallel'])
+    with pytest.raises(CodeFailed):
+        dc.run(parallel=2, retry=2, retry_pause=0.1)
+    assert len(dc.doc_blocks[0].runs) == 1
+    assert len(dc.doc_blocks[1].runs) == 3
+    assert dc.step == 2
+
+def test_doccommander_run__parallel_interrupted():
+    dc = rc.DocCommander()
+    dc.add('sleep 30\n', ['bash','parallel'])
+    dc.add('sleep 30\n', ['bash','parallel'])
+    dc.add('sleep 30\n', ['bash','parallel'])
+    def interrupt():
+        # wait for both interpreters, like Ctrl+C pressed while running them
+        while not all(b.process for b in dc.doc_blocks[:2]):
+            time.sleep(0.05)
+        os.kill(os.getpid(), signal.SIGINT)
+    threading.Thread(target=interrupt, daemon=True).start()
+    time_start = time.time()
+    with pytest.raises(KeyboardInterrupt):
+        dc.run(parallel=2)
+    assert time.time() - time_start < 15
+    # running blocks are killed, queued one never starts
+    for doc_block in dc.doc_blocks[:2]:
+        assert doc_block.last_run['retcode'] != 0
+    assert dc.doc_blocks[2].runs == []
+
 ###
 # Tests for parsers.py
 ###
@@ -604,6 +775,14 @@ def test_parsers__mkd_to_html__select_must_have_test2():
     data = '```bash#test1\nls\n```\n\n```bash#test2\nls -al\n```'
     assert rp.mkd_to_html(data, '', 'test2', '') == '<pre><code class="bash test1">ls\n</code></pre>\n\n<pre><code class="bash test2 rundoc_selected">ls -al\n</code></pre>'
 
+def test_parsers__mkd_to_html__cached():
+    data = '```bash#test1\nls\n```\n\n```bash#test2\nls -al\n```'
+    rp.mkd_to_html.cache_clear()
+    html_data = rp.mkd_to_html(data, 'test1')
+    assert rp.mkd_to_html(data, 'test1') is html_data
+    assert rp.mkd_to_html.cache_info().hits == 1
+    assert rp.mkd_to_html(data, 'test2') != html_data
+
 def test_parsers__parse_doc():
     f = io.StringIO()
     data = '```env\na=b\n```\n```bash#test1\nls\n```\n\n```bash#test2\nls -al\n```'
@@ -615,6 +794,15 @@ def test_parsers__parse_doc():
     c = rp.parse_doc(f, 'bash')
     assert c.get_dict() == expected.get_dict()
 
+def test_parsers__parse_doc__empty_secrets():
+    data = '```secrets\n```\n```env\na=b\n```\n```bash#test1\nls\n```'
+    expected = rc.DocCommander()
+    expected.add('ls\n', ['bash','test1'])
+    expected.env.import_string("a=b")
+    c = rp.parse_doc(io.StringIO(data))
+    assert c.get_dict() == expected.get_dict()
+    assert list(c.secrets) == []
+
 def test_parsers__parse_doc__single_session():
     f = io.StringIO()
     data = '```env\na=b\n```\n```bash#test1\nls\n```\n\n```bash#test2\nls -al\n```'
@@ -626,6 +814,49 @@ def test_parsers__parse_doc__single_session():
     c = rp.parse_doc(f, single_session='bash')
     assert c.get_dict() == expected.get_dict()
 
+def test_parsers__parse_doc__cache(sandbox, monkeypatch):
+    monkeypatch.setenv('XDG_CACHE_HOME', sandbox)
+    data = '```env\na=b\n```\n```bash#test1\nls\n```\n\n```bash#test2\nls -al\n```'
+    c1 = rp.parse_doc(io.StringIO(data), 'bash', cache=True)
+    cache_files = os.listdir(os.path.join(sandbox, 'rundoc'))
+    assert len(cache_files) == 1
+    def fail(*args, **kwargs):
+        raise AssertionError("markdown parsed despite cache")
+    monkeypatch.setattr(rp, '_extract_doc', fail)
+    c2 = rp.parse_doc(io.StringIO(data), 'bash', cache=True)
+    assert c1.get_dict() == c2.get_dict()
+    assert str(c1.env) == str(c2.env)
+    with pytest.raises(AssertionError):
+        rp.parse_doc(io.StringIO(data), 'test1', cache=True)
+
+def test_parsers__parse_doc__cache_version(sandbox, monkeypatch):
+    import markdown_rundoc
+    monkeypatch.setenv('XDG_CACHE_HOME', sandbox)
+    data = '```bash#test1\nls\n```'
+    rp.parse_doc(io.StringIO(data), cache=True)
+    monkeypatch.setattr(markdown_rundoc, '__version__', '0.0.0')
+    rp.parse_doc(io.StringIO(data), cache=True)
+    assert len(os.listdir(os.path.join(sandbox, 'rundoc'))) == 2
+
+def test_parsers__parse_doc__cache_unavailable(sandbox, monkeypatch):
+    not_a_dir = os.path.join(sandbox, 'not_a_dir')
+    open(not_a_dir, 'w').close()
+    monkeypatch.setenv('XDG_CACHE_HOME', not_a_dir)
+    data = '```env\na=b\n```\n```bash#test1\nls\n```'
+    c = rp.parse_doc(io.StringIO(data), cache=True)
+    assert c.get_dict() == rp.parse_doc(io.StringIO(data)).get_dict()
+    assert rp.get_tags(io.StringIO(data), cache=True) == rp.get_tags(
+        io.StringIO(data))
+
+def test_parsers__write_cache__failed(sandbox, monkeypatch):
+    path = os.path.join(sandbox, 'cache.json')
+    rp._write_cache(path, {'not serializable': object()})
+    def fail(*args):
+        raise OSError("replace failed")
+    monkeypatch.setattr(rp.os, 'replace', fail)
+    rp._write_cache(path, {'a': 'b'})
+    assert os.listdir(sandbox) == []
+
 def test_parsers__parse_output():
     data = '```env\na=b\n```\n```bash#test1\nls\n```\n\n```bash#test2\nls -al\n```'
     input = io.StringIO()
@@ -657,6 +888,17 @@ def test_parsers__get_tags():
         else:
             assert tag == ''
 
+def test_parsers__get_tags__cache(sandbox, monkeypatch):
+    monkeypatch.setenv('XDG_CACHE_HOME', sandbox)
+    data = '```env\na=b\n```\n```bash#test1\nls\n```\n\n```bash#test2\nls -al\n```'
+    tags1 = rp.get_tags(io.StringIO(data), cache=True)
+    def fail(*args, **kwargs):
+        raise AssertionError("markdown parsed despite cache")
+    monkeypatch.setattr(rp, '_count_tags', fail)
+    tags2 = rp.get_tags(io.StringIO(data), cache=True)
+    assert tags1 == tags2
+    assert tags2[0] == ('bash', 2)
+
 def test_parsers__get_blocks():
     data = '```env\na=b\n```\n```bash#test1\nls\n```\n\n```bash#test2\nls -al\n```'
     input = io.StringIO()
@@ -692,8 +934,18 @@ def test_parsers__get_clean_doc():
 
 def test_main_add_options():
     rm.add_options(rm._run_control_options)
+    rm.add_options(rm._parse_options)
     rm.add_options(rm._run_specific_options)
     rm.add_options(rm._output_style_options)
     rm.add_options(rm._tag_options)
 
 
+
+def test_main_run__negative_parallel(sandbox):
+    from click.testing import CliRunner
+    input = os.path.join(sandbox, 'input.md')
+    with open(input, 'w') as f:
+        f.write('```bash\necho test\n```\n')
+    result = CliRunner().invoke(rm.cli, ['run', '--parallel', '-1', input])
+    assert result.exit_code == 2
+    assert 'Invalid value' in result.output